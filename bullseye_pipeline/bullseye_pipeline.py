@@ -59,7 +59,7 @@ def create_bullseye_pipeline(scans_dir, work_dir, outputdir, subject_ids, name='
     aparc2aseg.dmax = 1000
     aparc2aseg.inputs.rip = True
     aparc2aseg.inputs.hypo = True
-    aparc2aseg.inputs.out_file = 'lobes+aseg.nii.gz'
+    aparc2aseg.inputs.out_file = 'lobes+aseg.nii'  # intermediate outputs are left uncompressed (faster to write and read)
 
     # group some lobes and discard others
     filter_lobes = pe.Node(interface=util.Function(input_names=['in_file', 'include_superlist', 'fixed_id', 'map_pairs_list'], output_names=['out_file'],
@@ -92,8 +92,9 @@ def create_bullseye_pipeline(scans_dir, work_dir, outputdir, subject_ids, name='
     bgt_mask.inputs.map_pairs_list = None
 
     # create normalized distance map
-    ndist_map = pe.Node(interface=util.Function(input_names=['orig_file', 'dest_file'], output_names=['out_file'],
+    ndist_map = pe.Node(interface=util.Function(input_names=['orig_file', 'dest_file', 'n_threads'], output_names=['out_file'],
                                                 function=norm_dist_map), name='ndist_map')
+    ndist_map.inputs.n_threads = 1  # MultiProc already runs one process per node
 
     # generate WM parcellations by filling the discarded lobes (3003, 4003) and unsegmented white matter (5001, 5002)
     gen_wmparc = pe.Node(interface=util.Function(input_names=['incl_file', 'ndist_file', 'label_file', 'incl_labels', 'verbose'], output_names=['out_file'],
@@ -30,7 +30,7 @@ def main():
     parser.add_argument('-o', '--output_dir', help='Output directory where results will be stored', required=True)
     parser.add_argument('--subjects', help='One or more subject IDs (space separated)', default=None, required=False, nargs='+', action='append')
     parser.add_argument('-b', '--debug', help='debug mode', action='store_true')
-    parser.add_argument('-p', '--processes', help='overall number of parallel processes', default=1, type=int)
+    parser.add_argument('-p', '--processes', help='overall number of parallel processes (default: number of CPUs)', default=os.cpu_count(), type=int)
     parser.add_argument('-n', '--name', help='Pipeline workflow name', default='bullseye_pipeline')
     
     # args = parser.parse_args('-s /home/sanromag/DATA/WMH/data_nodenoise/scans2 '
@@ -116,4 +116,4 @@ if __name__ == '__main__':
     )
 
     print('Running workflow now…')
-    bullwf.run(plugin='MultiProc', plugin_args={'n_procs': 4})
+    bullwf.run(plugin='MultiProc', plugin_args={'n_procs': os.cpu_count()})
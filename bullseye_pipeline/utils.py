@@ -43,6 +43,10 @@ from nipype.interfaces.base import (
 
 import os
 
+# FreeSurfer binaries (resolved through PATH if FREESURFER_HOME is not set)
+_FS_HOME = os.environ.get('FREESURFER_HOME')
+_FS_BIN = os.path.join(_FS_HOME, 'bin') if _FS_HOME else ''
+
 def filter_labels(in_file, include_superlist, fixed_id=None, map_pairs_list=None):
     """filters-out labels not in the include-superset. Merges labels within superset. Transforms label-ids according to mappings (or fixed id)"""
     import nibabel as nib
@@ -50,8 +54,22 @@ def filter_labels(in_file, include_superlist, fixed_id=None, map_pairs_list=None
     import os
 
     in_nib = nib.load(in_file)
-    in_data = in_nib.get_fdata()
-    new_data = np.zeros_like(in_data)
+    in_data = np.asanyarray(in_nib.dataobj)
+    if not np.issubdtype(in_data.dtype, np.integer):
+        in_data = in_data.astype(np.int32)  # integer label-ids are used directly to index the look-up table
+
+    # requested label-ids, and the ids they are given (int16 output unless they do not fit)
+    in_ids = [int(label) for labels_list in include_superlist for label in labels_list]
+    new_ids = [int(fixed_id[0]) if fixed_id is not None else int(labels_list[0]) for labels_list in include_superlist]
+    if map_pairs_list is not None:
+        new_ids += [int(new_label) for _, new_label in map_pairs_list]
+    int16_info = np.iinfo(np.int16)
+    lut_dtype = np.int16 if all(int16_info.min <= i <= int16_info.max for i in new_ids) else np.int32
+
+    # look-up table indexed by original label-id, shifted by the lowest id so that negative ids are covered too
+    min_label = min([0, int(in_data.min())] + in_ids)
+    max_label = max([int(in_data.max())] + in_ids)
+    lut = np.zeros(max_label - min_label + 1, dtype=lut_dtype)
 
     # Step 1: group and relabel
     for labels_list in include_superlist:
@@ -59,47 +77,81 @@ def filter_labels(in_file, include_superlist, fixed_id=None, map_pairs_list=None
             new_label = fixed_id[0]
         else:
             new_label = labels_list[0]  # unified label within the group
-        for label in labels_list:
-            new_data[in_data == label] = new_label
+        lut[np.asarray(labels_list, dtype=np.int64) - min_label] = new_label
 
-    # Step 2: apply mapping
+    # Step 2: apply mapping (on the table itself, always matching against the relabeled ids of step 1)
     if map_pairs_list is not None:
-        mapped_data = np.copy(new_data)
+        relabeled = np.copy(lut)
         for old_label, new_label in map_pairs_list:
-            mapped_data[new_data == old_label] = new_label
-        final_data = mapped_data
+            lut[relabeled == old_label] = new_label
+
+    # single pass over the volume
+    if min_label < 0:
+        final_data = lut[in_data.astype(np.int32) - min_label]
     else:
-        final_data = new_data
+        final_data = lut[in_data]
 
     # Save result
-    out_nib = nib.Nifti1Image(final_data.astype(np.int16), in_nib.affine, in_nib.header)
-    nib.save(out_nib, 'filtered.nii.gz')
-    return os.path.abspath('filtered.nii.gz')
+    out_hdr = in_nib.header.copy()
+    if lut_dtype == np.int32:  # keep ids that do not fit in int16 unscaled
+        out_hdr.set_data_dtype(np.int32)
+    out_nib = nib.Nifti1Image(final_data, in_nib.affine, out_hdr)
+    nib.save(out_nib, 'filtered.nii')
+    return os.path.abspath('filtered.nii')
 
 
-def norm_dist_map(orig_file, dest_file):
-    """compute normalized distance map given an origin and destination masks, resp."""
+def norm_dist_map(orig_file, dest_file, n_threads=1):
+    """compute normalized distance map given an origin and destination masks, resp.
+    'n_threads' is the number of threads used by the (optional) multi-threaded distance transform.
+    """
     import os
     import nibabel as nib
     import numpy as np
-    from scipy.ndimage.morphology import distance_transform_edt
 
     orig_nib = nib.load(orig_file)
     dest_nib = nib.load(dest_file)
 
-    orig = orig_nib.get_fdata()
-    dest = dest_nib.get_fdata()
+    orig = np.asanyarray(orig_nib.dataobj).astype(bool, copy=False)
+    dest = np.asanyarray(dest_nib.dataobj).astype(bool, copy=False)
+
+    zooms = orig_nib.header.get_zooms()[:3]
 
-    dist_orig = distance_transform_edt(np.logical_not(orig.astype(bool)))
-    dist_dest = distance_transform_edt(np.logical_not(dest.astype(bool)))
+    # use the fastest euclidean distance transform available: cucim (CUDA) > edt (multi-threaded) > scipy.
+    # All of them give float64 distances, as scipy does (edt only returns float32, so the square root of its
+    # squared distances is taken in double precision, which matches scipy exactly for isotropic voxels)
+    try:
+        import cupy as cp
+        from cucim.core.operations.morphology import distance_transform_edt as cucim_edt
+        use_cuda = cp.cuda.is_available()
+    except ImportError:
+        use_cuda = False
 
-    # normalized distance (0 in origin to 1 in dest)
-    ndist = dist_orig / (dist_orig + dist_dest)
+    if use_cuda:
+        def distance_transform(mask):
+            return cp.asnumpy(cucim_edt(cp.asarray(mask), sampling=zooms, float64_distances=True))
+    else:
+        try:
+            import edt
+
+            def distance_transform(mask):
+                return np.sqrt(edt.edtsq(mask, anisotropy=zooms, parallel=n_threads), dtype=np.float64)
+        except ImportError:
+            from scipy.ndimage.morphology import distance_transform_edt
+
+            def distance_transform(mask):
+                return distance_transform_edt(mask, sampling=zooms)
+
+    dist_orig = distance_transform(np.logical_not(orig))
+    dist_dest = distance_transform(np.logical_not(dest))
 
-    ndist_nib = nib.Nifti1Image(ndist.astype(np.float32), orig_nib.affine)
-    nib.save(ndist_nib, 'ndist.nii.gz')
+    # normalized distance (0 in origin to 1 in dest), computed in double precision and only stored in the output dtype
+    ndist = np.empty(dist_orig.shape, dtype=np.float32)
+    np.divide(dist_orig, dist_orig + dist_dest, out=ndist)
 
-    return os.path.abspath('ndist.nii.gz')
+    ndist_nib = nib.Nifti1Image(ndist, orig_nib.affine)
+    nib.save(ndist_nib, 'ndist.nii')
+
+    return os.path.abspath('ndist.nii')
 
 def create_shells(ndist_file, n_shells=4, out_file = 'shells.nii.gz', mask_file=None):
     """creates specified number of shells given normalized distance map. When mask is given, output in mask == 0 is set to zero"""
@@ -114,17 +166,16 @@ def create_shells(ndist_file, n_shells=4, out_file = 'shells.nii.gz', mask_file=
     if mask_file is not None:
         mask_nib = nib.load(mask_file)
         assert mask_nib.header.get_data_shape() == ndist_nib.header.get_data_shape(), "Different shapes of images"
-        mask = mask_nib.get_fdata() > 0
-
-    out = np.zeros(ndist.shape, dtype=np.int8)
+        mask = np.asanyarray(mask_nib.dataobj) > 0
 
     limits = np.linspace(0., 1., n_shells+1)
-    for i in np.arange(n_shells)+1:
-        # compute shell and assing increasing label-id
-        mask2 = np.logical_and(ndist >= limits[i-1], ndist < limits[i])
-        if mask_file is not None:  # maskout regions outside mask
-            mask2 = np.logical_and(mask2, mask)
-        out[mask2] = i
+
+    # compute shells in a single pass, assigning increasing label-id i to limits[i-1] <= ndist < limits[i]
+    out = np.digitize(ndist, limits[1:-1]).astype(np.int8)
+    out += 1
+    out[np.logical_not(np.logical_and(ndist >= 0., ndist < 1.))] = 0  # outside the shells
+    if mask_file is not None:  # maskout regions outside mask
+        out[np.logical_not(mask)] = 0
     out[np.isclose(ndist, 0.)] = 0  # need to assign zero to ventricles because of >= above
 
     aux_hdr = ndist_nib.header
@@ -147,8 +198,8 @@ def merge_labels(in1_file, in2_file, out_file='merged.nii.gz', intersect=False):
 
     assert in1_nib.header.get_data_shape() == in2_nib.header.get_data_shape(), "Different shapes of images"
 
-    in1 = in1_nib.get_fdata()
-    in2 = in2_nib.get_fdata()
+    in1 = np.asanyarray(in1_nib.dataobj)
+    in2 = np.asanyarray(in2_nib.dataobj)
 
     out = None
 
@@ -168,20 +219,21 @@ def merge_labels(in1_file, in2_file, out_file='merged.nii.gz', intersect=False):
     # if intersection, create new label-set as cartesian product of the two sets
     else:
 
-        out = np.zeros(in1.shape, dtype=np.int32)
+        # label pairs [u1, u2] where both labels are present
+        both = np.logical_and(in1 > 0, in2 > 0)
+        u1 = in1[both].astype(np.int32)
+        u2 = in2[both].astype(np.int32)
 
-        u1_set = np.unique(in1.ravel())
-        u2_set = np.unique(in2.ravel())
+        # multiplier shifting u1 by the number of digits of each u2 (10 for 1..9, 100 for 10..99, ...)
+        mult = np.full(int(u2.max(initial=0)) + 1, 10, dtype=np.int32)
+        power = 10
+        while power < mult.size:
+            mult[power:] *= 10
+            power *= 10
 
-        for u1 in u1_set:
-            if u1 == 0: continue
-            mask1 = in1 == u1
-            for u2 in u2_set:
-                if u2 == 0: continue
-                mask2 = in2 == u2
-                mask3 = np.logical_and(mask1, mask2)
-                if not np.any(mask3): continue
-                out[mask3] = int(f"{int(u1)}{int(u2)}")  # new label id by concatenating [u1, u2]
+        # new label id by concatenating [u1, u2]
+        out = np.zeros(in1.shape, dtype=np.int32)
+        out[both] = u1 * mult[u2] + u2
 
         aux_hdr = in1_nib.header
         aux_hdr.set_data_dtype(np.int32)
@@ -199,7 +251,7 @@ def generate_wmparc(incl_file, ndist_file, label_file, incl_labels=None, verbose
     import os
     import nibabel as nib
     import numpy as np
-    from scipy.ndimage.morphology import binary_dilation, generate_binary_structure, iterate_structure
+    from scipy.ndimage.morphology import generate_binary_structure, iterate_structure
 
     connectivity = generate_binary_structure(3, 2)
 
@@ -213,7 +265,7 @@ def generate_wmparc(incl_file, ndist_file, label_file, incl_labels=None, verbose
 
     # create inclusion mask
     incl_mask = None
-    incl_aux = incl_nib.get_fdata()
+    incl_aux = np.asanyarray(incl_nib.dataobj)
     if incl_labels is None:
         incl_mask = incl_aux > 0
     else:
@@ -222,87 +274,133 @@ def generate_wmparc(incl_file, ndist_file, label_file, incl_labels=None, verbose
             incl_mask[incl_aux == lab] = True
 
     # get rest of numpy arrays
-    ndist = ndist_nib.get_fdata()
-    label = label_nib.get_fdata()
+    ndist = np.ascontiguousarray(ndist_nib.get_fdata())
+    label = np.asanyarray(label_nib.dataobj)
 
     # get DONE and processing masks
-    DONE_mask = label > 0  # this is for using freesurfer wmparc
-    proc_mask = np.logical_and(np.logical_and(ndist > 0., ndist < 1.), incl_mask)
+    DONE_mask = np.ascontiguousarray(label > 0)  # this is for using freesurfer wmparc
+    proc_mask = ndist > 0.
+    proc_mask &= ndist < 1.
+    proc_mask &= incl_mask
 
     # setup the ouptut vol
-    out = np.zeros(label.shape, dtype=label.dtype)
+    out = np.zeros(label.shape, dtype=np.int16)
 
     # initialize labels in cortex
     out[DONE_mask] = label[DONE_mask]  # this is for using freesurfer wmparc
 
+    # flat views of the (C-ordered) volumes, to address neighbors with flat offsets
+    ndist_flat = ndist.ravel()
+    out_flat = out.ravel()
+    done_flat = DONE_mask.ravel()
+
     # start with connectivity 1
     its_conn = 1
 
+    def shifted_views(off, shape):
+        """views (target, neighbor) of a volume, such that target[p] is paired with neighbor[p + off]"""
+        trg = tuple(slice(max(0, -o), s - max(0, o)) for o, s in zip(off, shape))
+        nbr = tuple(slice(max(0, o), s - max(0, -o)) for o, s in zip(off, shape))
+        return trg, nbr
+
+    # number of points to process and already DONE
+    n_proc = int(proc_mask.sum())
+    n_done = int(np.logical_and(DONE_mask, proc_mask).sum())
+
+    # neighbors at current connectivity
+    offsets = np.argwhere(iterate_structure(connectivity, its_conn)) - its_conn
+
+    def label_frontier(order, ndist, out, done, shape, offsets):
+        """labels the TO-DO points (flat indices) one after the other in the given order, so that later points
+        see the labels of earlier ones. Each point takes the label of its DONE neighbor with largest ndist
+        (first one in offsets order on ties). Returns the points without DONE neighbors.
+        Legacy quirk, kept to reproduce the original output: the original loop indexed the volume with
+        idx + off and caught the IndexError, so neighbors past the upper border are skipped, but negative
+        indices wrap around and neighbors past the lower border are read from the opposite face of the volume.
+        """
+        nx, ny, nz = shape
+        wrong = np.zeros(order.size, dtype=np.bool_)
+        for n in range(order.size):
+            i = order[n]
+            x, y, z = i // (ny * nz), (i // nz) % ny, i % nz
+            max_dist = -1.
+            for k in range(offsets.shape[0]):
+                xn, yn, zn = x + offsets[k, 0], y + offsets[k, 1], z + offsets[k, 2]
+                # skip neighbors past the upper border (IndexError), wrap around those past the lower one
+                if xn >= nx or yn >= ny or zn >= nz or xn < -nx or yn < -ny or zn < -nz:
+                    continue
+                if xn < 0:
+                    xn += nx
+                if yn < 0:
+                    yn += ny
+                if zn < 0:
+                    zn += nz
+                j = (xn * ny + yn) * nz + zn
+                # if it is DONE and the largest distance (ie, largest gradient)
+                if done[j] and ndist[j] > max_dist:
+                    out[i] = out[j]
+                    max_dist = ndist[j]
+            wrong[n] = max_dist < 0.
+            # mark as solved
+            done[i] = True
+        return order[wrong]
+
+    # JIT-compile the labeling of each frontier when numba is available (same result, slower python loop otherwise)
+    try:
+        from numba import njit
+        label_frontier = njit(label_frontier)
+    except ImportError:
+        pass
+
     # main loop
-    while not np.all(DONE_mask[proc_mask]):
+    while n_done < n_proc:
 
         if verbose:
-            print('%0.1f done' % (100. * float(DONE_mask[proc_mask].sum()) / float(proc_mask.sum())))
+            print('%0.1f done' % (100. * float(n_done) / float(n_proc)))
 
         # loop to increase connectivity for non-reachable TO-DO points
         while True:
 
-            # dilate the SOLVED area
-            aux = binary_dilation(DONE_mask, iterate_structure(connectivity, its_conn))
+            # dilate the SOLVED area by one step of the current connectivity (OR of shifted views)
+            aux = np.copy(DONE_mask)
+            for off in offsets:
+                trg, nbr = shifted_views(off, DONE_mask.shape)
+                aux[trg] |= DONE_mask[nbr]
             # next TO-DO: close to DONE, in the processing mask and not yet done
-            TODO_mask = np.logical_and(np.logical_and(aux, proc_mask), np.logical_not(DONE_mask))
+            TODO_mask = aux
+            TODO_mask &= proc_mask
+            TODO_mask[DONE_mask] = False
 
-            if TODO_mask.sum() > 0:
+            n_todo = int(TODO_mask.sum())
+            if n_todo > 0:
                 break
 
             if verbose:
                 print('Non-reachable points. Increasing connectivity')
 
             its_conn += 1
+            offsets = np.argwhere(iterate_structure(connectivity, its_conn)) - its_conn
 
-        # sort TO-DO points by ndist
-        Idx_TODO = np.argwhere(TODO_mask)
-        Idx_ravel = np.ravel_multi_index(Idx_TODO.T, label.shape)
-        I_sort = np.argsort(ndist.ravel()[Idx_ravel])
-
-        # iterate along TO-DO points
-        for idx in Idx_TODO[I_sort[::-1]]:
-
-            max_dist = -1.
-
-            # process each neighbor
-            for off in np.argwhere(iterate_structure(connectivity, its_conn)) - its_conn:
-
-                try:
-
-                    # if it is not DONE then skip
-                    if not DONE_mask[idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]]:
-                        continue
-
-                    # if it is the largest distance (ie, largest gradient)
-                    cur_dist = ndist[idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]]
-                    if cur_dist > max_dist:
-                        out[idx[0], idx[1], idx[2]] = out[idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]]
-                        max_dist = cur_dist
-
-                except:
-                    print('something wrong with neighbor at: (%d, %d, %d)' % (
-                    idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]))
-                    pass
+        # sort TO-DO points by decreasing ndist, and label them one by one in that order. This is not a vectorized
+        # batch on purpose: later points of a frontier can take their label from earlier ones, and labeling them
+        # all at once from the previous frontiers changes the result
+        Idx_ravel = np.flatnonzero(TODO_mask)
+        I_sort = np.argsort(ndist_flat[Idx_ravel])
+        wrong = label_frontier(Idx_ravel[I_sort[::-1]], ndist_flat, out_flat, done_flat, label.shape, offsets)
 
-            if max_dist < 0.: print("something went wrong with point: (%d, %d, %d)" % (idx[0], idx[1], idx[2]))
+        for x, y, z in zip(*np.unravel_index(wrong, label.shape)):
+            print("something went wrong with point: (%d, %d, %d)" % (x, y, z))
 
-            # mark as solved and remove from visited
-            DONE_mask[idx[0], idx[1], idx[2]] = True
+        n_done += n_todo
 
     # # remove labels from cortex (old aparc version)
     # out[dest_mask] = 0
 
     print('Writing output labelmap')
-    out_nib = nib.Nifti1Image(out.astype(np.int16), label_nib.affine, label_nib.header)
-    nib.save(out_nib, 'wmparc.nii.gz')
+    out_nib = nib.Nifti1Image(out, label_nib.affine, label_nib.header)
+    nib.save(out_nib, 'wmparc.nii')
 
-    return os.path.abspath('wmparc.nii.gz')
+    return os.path.abspath('wmparc.nii')
 
 
 class Annot2LabelInputSpec(CommandLineInputSpec):
@@ -318,7 +416,7 @@ class Annot2Label(CommandLine):
     """wrapper for FreeSurfer command-line tool 'mri_annotation2label'"""
     input_spec = Annot2LabelInputSpec
     output_spec = Annot2LabelOutputSpec
-    _cmd = os.path.join(os.environ['FREESURFER_HOME'], 'bin', 'mri_annotation2label')
+    _cmd = os.path.join(_FS_BIN, 'mri_annotation2label')
 
     def _list_outputs(self):
             outputs = self.output_spec().get()
@@ -352,7 +450,7 @@ class Aparc2Aseg(CommandLine):
     input_spec = Aparc2AsegInputSpec
     output_spec = Aparc2AsegOutputSpec
 
-    _cmd = os.path.join(os.environ['FREESURFER_HOME'], 'bin', 'mri_aparc2aseg')
+    _cmd = os.path.join(_FS_BIN, 'mri_aparc2aseg')
 
     def _list_outputs(self):
             outputs = self.output_spec().get()
@@ -0,0 +1,58 @@
+"""
+checks that create_shells gives the same depth shells as the original implementation, copied below as reference,
+including distances at the shell limits, outside [0, 1) and undefined, with and without a mask.
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+pytest.importorskip('nipype')
+
+from bullseye_pipeline.utils import create_shells
+
+
+def reference_shells(ndist, n_shells=4, mask=None):
+    """original shells of create_shells, on arrays"""
+    out = np.zeros(ndist.shape, dtype=np.int8)
+
+    limits = np.linspace(0., 1., n_shells+1)
+    for i in np.arange(n_shells)+1:
+        mask2 = np.logical_and(ndist >= limits[i-1], ndist < limits[i])
+        if mask is not None:
+            mask2 = np.logical_and(mask2, mask)
+        out[mask2] = i
+    out[np.isclose(ndist, 0.)] = 0
+
+    return out
+
+
+def random_ndist(n_shells, shape=(20, 22, 18), seed=0):
+    """random normalized distances, with a share of them exactly at the shell limits and of special values"""
+    rng = np.random.default_rng(seed)
+    ndist = rng.random(shape).astype(np.float32)
+    special = np.concatenate([np.linspace(0., 1., n_shells+1), [1e-9, -0.1, 1.5, np.nan]]).astype(np.float32)
+    pick = rng.random(shape) < 0.3
+    ndist[pick] = special[rng.integers(special.size, size=int(pick.sum()))]
+    return ndist
+
+
+def run_shells(tmp_path, ndist, n_shells, mask=None):
+    nib.save(nib.Nifti1Image(ndist, np.eye(4)), str(tmp_path / 'ndist.nii.gz'))
+    mask_file = None
+    if mask is not None:
+        mask_file = str(tmp_path / 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(mask.astype(np.int8), np.eye(4)), mask_file)
+    out_file = create_shells(str(tmp_path / 'ndist.nii.gz'), n_shells=n_shells,
+                             out_file=str(tmp_path / 'shells.nii.gz'), mask_file=mask_file)
+    out_nib = nib.load(out_file)
+    return np.asanyarray(out_nib.dataobj), out_nib.get_data_dtype()
+
+
+@pytest.mark.parametrize('n_shells', [3, 4, 5])
+@pytest.mark.parametrize('masked', [False, True])
+def test_shells(n_shells, masked, tmp_path):
+    ndist = random_ndist(n_shells)
+    mask = np.random.default_rng(1).random(ndist.shape) < 0.8 if masked else None
+    out, out_dtype = run_shells(tmp_path, ndist, n_shells, mask)
+    assert out_dtype == np.int8
+    np.testing.assert_array_equal(out, reference_shells(ndist.astype(np.float64), n_shells, mask))
@@ -0,0 +1,88 @@
+"""
+checks that filter_labels gives the same labelmaps as the original implementation, copied below as reference,
+with the configurations used in the pipeline, negative label-ids and label-ids that do not fit in int16.
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+pytest.importorskip('nipype')
+
+from bullseye_pipeline.utils import filter_labels
+
+
+def reference_filter(in_data, include_superlist, fixed_id=None, map_pairs_list=None):
+    """original relabeling of filter_labels, on arrays (before the final int16 cast)"""
+    new_data = np.zeros_like(in_data)
+
+    for labels_list in include_superlist:
+        if fixed_id is not None:
+            new_label = fixed_id[0]
+        else:
+            new_label = labels_list[0]
+        for label in labels_list:
+            new_data[in_data == label] = new_label
+
+    if map_pairs_list is not None:
+        mapped_data = np.copy(new_data)
+        for old_label, new_label in map_pairs_list:
+            mapped_data[new_data == old_label] = new_label
+        final_data = mapped_data
+    else:
+        final_data = new_data
+
+    return final_data
+
+
+# aseg and lobes+aseg label-ids found in the pipeline inputs (and some that are not requested)
+ASEG_IDS = [0, 2, 4, 10, 11, 12, 13, 26, 41, 43, 49, 50, 51, 52, 58, 1001, 1004, 1005, 1006, 1007, 2001, 2004,
+            2005, 2006, 2007, 3001, 3004, 3005, 3006, 3007, 4001, 4004, 4005, 4006, 4007, 5001, 5002]
+
+# (include_superlist, fixed_id, map_pairs_list) of the filter_labels nodes of the pipeline
+PIPELINE_CONFIGS = {
+    'filter_lobes': ([[3001, 3007], [4001, 4007], [3004], [4004], [3005], [4005], [3006], [4006]], None,
+                     [[3001, 11], [4001, 21], [3004, 12], [4004, 22], [3005, 13], [4005, 23], [3006, 14], [4006, 24]]),
+    'ventricles_mask': ([[43, 4]], [1], None),
+    'cortex_mask': ([[1001, 2001, 1004, 2004, 1005, 2005, 1006, 2006]], [1], None),
+    'bgt_mask': ([[10, 49, 11, 12, 50, 51, 26, 58, 13, 52]], [5], None),
+}
+
+
+def random_labels(label_ids, shape=(20, 22, 18), seed=0):
+    rng = np.random.default_rng(seed)
+    return np.asarray(label_ids)[rng.integers(len(label_ids), size=shape)]
+
+
+def run_filter(tmp_path, in_data, *args):
+    nib.save(nib.Nifti1Image(in_data, np.eye(4)), str(tmp_path / 'in.nii.gz'))
+    out_file = filter_labels(str(tmp_path / 'in.nii.gz'), *args)
+    return np.asanyarray(nib.load(out_file).dataobj)
+
+
+@pytest.mark.parametrize('config', sorted(PIPELINE_CONFIGS))
+@pytest.mark.parametrize('dtype', [np.int32, np.float32])
+def test_pipeline_configs(config, dtype, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    in_data = random_labels(ASEG_IDS).astype(dtype)
+    out = run_filter(tmp_path, in_data, *PIPELINE_CONFIGS[config])
+    np.testing.assert_array_equal(out, reference_filter(in_data, *PIPELINE_CONFIGS[config]).astype(np.int16))
+
+
+def test_negative_labels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    in_data = random_labels([-7, -3, -1, 0, 2, 5, 9]).astype(np.int16)
+    args = ([[-3, 2], [5, -1]], None, [[5, -2], [-3, 8]])
+    out = run_filter(tmp_path, in_data, *args)
+    np.testing.assert_array_equal(out, reference_filter(in_data, *args))
+
+
+@pytest.mark.parametrize('label_ids, dtype', [([0, 3, 7, 40000, 65000], np.int32), ([-5, 0, 3, 7], np.int16)])
+def test_large_labels(label_ids, dtype, tmp_path, monkeypatch):
+    # label-ids above the int16 range are kept (saved as int32), instead of wrapping around
+    monkeypatch.chdir(tmp_path)
+    in_data = random_labels(label_ids).astype(dtype)
+    args = ([[40000, 3], [7]], None, [[7, 50000]])
+    out = run_filter(tmp_path, in_data, *args)
+    assert out.dtype == np.int32
+    np.testing.assert_array_equal(out, reference_filter(in_data.astype(np.int32), *args))
+    assert set(np.unique(out)) == {0, 40000, 50000}
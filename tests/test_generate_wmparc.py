@@ -0,0 +1,133 @@
+"""
+checks that every backend of generate_wmparc (numba and python loop) gives the same parcellation
+as the original label propagation, copied below as reference.
+"""
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+ndimage = pytest.importorskip('scipy.ndimage')
+pytest.importorskip('nipype')
+
+from bullseye_pipeline.utils import generate_wmparc
+
+
+def reference_wmparc(incl_mask, ndist, label):
+    """original propagation loop of generate_wmparc, on arrays"""
+    connectivity = ndimage.generate_binary_structure(3, 2)
+
+    DONE_mask = label > 0
+    proc_mask = np.logical_and(np.logical_and(ndist > 0., ndist < 1.), incl_mask)
+
+    out = np.zeros(label.shape, dtype=label.dtype)
+    out[DONE_mask] = label[DONE_mask]
+
+    its_conn = 1
+
+    while not np.all(DONE_mask[proc_mask]):
+
+        while True:
+
+            aux = ndimage.binary_dilation(DONE_mask, ndimage.iterate_structure(connectivity, its_conn))
+            TODO_mask = np.logical_and(np.logical_and(aux, proc_mask), np.logical_not(DONE_mask))
+
+            if TODO_mask.sum() > 0:
+                break
+
+            its_conn += 1
+
+        Idx_TODO = np.argwhere(TODO_mask)
+        Idx_ravel = np.ravel_multi_index(Idx_TODO.T, label.shape)
+        I_sort = np.argsort(ndist.ravel()[Idx_ravel])
+
+        for idx in Idx_TODO[I_sort[::-1]]:
+
+            max_dist = -1.
+
+            for off in np.argwhere(ndimage.iterate_structure(connectivity, its_conn)) - its_conn:
+
+                try:
+
+                    if not DONE_mask[idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]]:
+                        continue
+
+                    cur_dist = ndist[idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]]
+                    if cur_dist > max_dist:
+                        out[idx[0], idx[1], idx[2]] = out[idx[0] + off[0], idx[1] + off[1], idx[2] + off[2]]
+                        max_dist = cur_dist
+
+                except IndexError:
+                    pass
+
+            DONE_mask[idx[0], idx[1], idx[2]] = True
+
+    return out.astype(np.int16)
+
+
+def phantom(shape=(24, 27, 22), seed=0):
+    """sphere of white matter between ventricles (ndist = 0) and cortex (ndist = 1), with lobe labels
+    on part of the voxels and the rest (incl == 5001) to be filled"""
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape).astype(float)
+    center = (np.array(shape, dtype=float)[:, None, None, None] - 1.) / 2.
+    rad = np.sqrt(((grid - center) ** 2).sum(0))
+    r_out = min(shape) / 2.
+
+    ndist = np.clip((rad - 3.) / (r_out - 3.) + 0.02 * rng.random(shape), 0., 1.).astype(np.float32)
+    wm = (ndist > 0.) & (ndist < 1.)
+    fill = wm & (rng.random(shape) < 0.7)
+
+    incl = np.zeros(shape, dtype=np.int16)
+    incl[wm] = 3001
+    incl[fill] = 5001
+
+    lobes = np.digitize(np.arctan2(grid[1] - center[1], grid[0] - center[0]), [-2., 0., 2.]) + 1
+    label = np.zeros(shape, dtype=np.int16)
+    label[wm & ~fill] = 10 * lobes[wm & ~fill]
+
+    return incl, ndist, label
+
+
+def run_wmparc(tmp_path, incl, ndist, label):
+    affine = np.eye(4)
+    for name, data in (('incl.nii.gz', incl), ('ndist.nii.gz', ndist), ('label.nii.gz', label)):
+        nib.save(nib.Nifti1Image(data, affine), str(tmp_path / name))
+    out_file = generate_wmparc(str(tmp_path / 'incl.nii.gz'), str(tmp_path / 'ndist.nii.gz'),
+                               str(tmp_path / 'label.nii.gz'), incl_labels=[5001])
+    return np.asanyarray(nib.load(out_file).dataobj)
+
+
+@pytest.fixture(params=['numba', 'python'])
+def backend(request, monkeypatch, tmp_path):
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+    else:
+        monkeypatch.setitem(sys.modules, 'numba', None)
+    monkeypatch.chdir(tmp_path)
+    return request.param
+
+
+def test_phantom(backend, tmp_path):
+    incl, ndist, label = phantom()
+    out = run_wmparc(tmp_path, incl, ndist, label)
+    np.testing.assert_array_equal(out, reference_wmparc(incl == 5001, ndist, label))
+
+
+def test_labels_at_border(backend, tmp_path):
+    # cropped phantom, so that labels and points to fill touch the volume border
+    incl, ndist, label = (vol[:15, 4:22, 8:].copy() for vol in phantom())
+    out = run_wmparc(tmp_path, incl, ndist, label)
+    np.testing.assert_array_equal(out, reference_wmparc(incl == 5001, ndist, label))
+
+
+def test_non_reachable_points(backend, tmp_path):
+    # island to fill, separated from the labels by a gap of non-included voxels
+    incl, ndist, label = phantom()
+    label[4:11, 4:11, 4:11] = 0
+    incl[4:11, 4:11, 4:11] = 3001
+    incl[6:9, 6:9, 6:9] = 5001
+    out = run_wmparc(tmp_path, incl, ndist, label)
+    np.testing.assert_array_equal(out, reference_wmparc(incl == 5001, ndist, label))
+    assert np.all(out[6:9, 6:9, 6:9][ndist[6:9, 6:9, 6:9] > 0.] > 0)
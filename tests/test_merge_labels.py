@@ -0,0 +1,88 @@
+"""
+checks that merge_labels gives the same labelmaps as the original implementation, copied below as reference,
+both when overwriting and when intersecting label-sets (including second labels with different number of digits).
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+pytest.importorskip('nipype')
+
+from bullseye_pipeline.utils import merge_labels
+
+
+def reference_merge(in1, in2, intersect=False):
+    """original merging of merge_labels, on arrays"""
+    if not intersect:
+
+        out = np.zeros(in1.shape, dtype=np.int8)
+
+        out[:] = in1[:]
+        mask = in2 > 0
+        out[mask] = in2[mask]
+
+    else:
+
+        out = np.zeros(in1.shape, dtype=np.int32)
+
+        u1_set = np.unique(in1.ravel())
+        u2_set = np.unique(in2.ravel())
+
+        for u1 in u1_set:
+            if u1 == 0: continue
+            mask1 = in1 == u1
+            for u2 in u2_set:
+                if u2 == 0: continue
+                mask2 = in2 == u2
+                mask3 = np.logical_and(mask1, mask2)
+                if not np.any(mask3): continue
+                out[mask3] = int(f"{int(u1)}{int(u2)}")
+
+    return out
+
+
+# lobar labels of the pipeline (lobes + basal ganglia / thalamus) and depth shells
+LOBE_IDS = [0, 5, 11, 12, 13, 14, 21, 22, 23, 24]
+SHELL_IDS = [0, 1, 2, 3, 4]
+
+
+def random_labels(label_ids, dtype, shape=(20, 22, 18), seed=0):
+    rng = np.random.default_rng(seed)
+    return np.asarray(label_ids)[rng.integers(len(label_ids), size=shape)].astype(dtype)
+
+
+def run_merge(tmp_path, in1, in2, intersect):
+    for name, data in (('in1.nii.gz', in1), ('in2.nii.gz', in2)):
+        nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path / name))
+    out_file = merge_labels(str(tmp_path / 'in1.nii.gz'), str(tmp_path / 'in2.nii.gz'),
+                            out_file=str(tmp_path / 'merged.nii.gz'), intersect=intersect)
+    out_nib = nib.load(out_file)
+    return np.asanyarray(out_nib.dataobj), out_nib.get_data_dtype()
+
+
+def test_overwrite(tmp_path):
+    # lobe_wmparc node: basal ganglia / thalamus mask over the lobes
+    in1 = random_labels(LOBE_IDS, np.int16, seed=0)
+    in2 = random_labels([0, 0, 0, 5], np.int16, seed=1)
+    out, out_dtype = run_merge(tmp_path, in1, in2, intersect=False)
+    assert out_dtype == np.int8
+    np.testing.assert_array_equal(out, reference_merge(in1, in2))
+
+
+@pytest.mark.parametrize('u2_ids, dtype2', [(SHELL_IDS, np.int8), (SHELL_IDS, np.float32),
+                                            ([0, 3, 9, 10, 42, 99, 100, 120], np.int16)])
+def test_intersect(u2_ids, dtype2, tmp_path):
+    # bullseye_wmparc node: lobes x shells, and second labels with a varying number of digits
+    in1 = random_labels(LOBE_IDS, np.int16, seed=0)
+    in2 = random_labels(u2_ids, dtype2, seed=1)
+    out, out_dtype = run_merge(tmp_path, in1, in2, intersect=True)
+    assert out_dtype == np.int32
+    np.testing.assert_array_equal(out, reference_merge(in1, in2, intersect=True))
+
+
+def test_intersect_empty(tmp_path):
+    in1 = random_labels(LOBE_IDS, np.int16, seed=0)
+    in2 = np.zeros(in1.shape, dtype=np.int8)
+    in2[in1 == 0] = 3
+    out, _ = run_merge(tmp_path, in1, in2, intersect=True)
+    assert not np.any(out)
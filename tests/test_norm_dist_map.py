@@ -0,0 +1,79 @@
+"""
+checks that every backend of norm_dist_map (cucim, edt and scipy) gives the same normalized distances as the
+original implementation, copied below as reference, and that they are exactly 0 in the origin and exactly 1 in the
+destination masks.
+"""
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+ndimage = pytest.importorskip('scipy.ndimage')
+pytest.importorskip('nipype')
+
+from bullseye_pipeline.utils import norm_dist_map
+
+
+def reference_ndist(orig, dest):
+    """original normalized distance of norm_dist_map, on arrays"""
+    dist_orig = ndimage.distance_transform_edt(np.logical_not(orig.astype(bool)))
+    dist_dest = ndimage.distance_transform_edt(np.logical_not(dest.astype(bool)))
+
+    ndist = dist_orig / (dist_orig + dist_dest)
+
+    return ndist.astype(np.float32)
+
+
+def phantom(shape=(64, 70, 60)):
+    """ventricles (origin) inside a cortex shell (destination)"""
+    grid = np.indices(shape).astype(float)
+    center = (np.array(shape, dtype=float)[:, None, None, None] - 1.) / 2.
+    rad = np.sqrt(((grid - center) ** 2).sum(0))
+    r_out = min(shape) / 2.
+
+    orig = (rad < 5.).astype(np.int16)
+    dest = ((rad > r_out - 6.) & (rad < r_out - 2.)).astype(np.int16)
+
+    return orig, dest
+
+
+def run_ndist(tmp_path, orig, dest):
+    affine = np.eye(4)
+    for name, data in (('orig.nii.gz', orig), ('dest.nii.gz', dest)):
+        nib.save(nib.Nifti1Image(data, affine), str(tmp_path / name))
+    out_file = norm_dist_map(str(tmp_path / 'orig.nii.gz'), str(tmp_path / 'dest.nii.gz'))
+    return np.asanyarray(nib.load(out_file).dataobj)
+
+
+@pytest.fixture(params=['cucim', 'edt', 'scipy'])
+def backend(request, monkeypatch, tmp_path):
+    # block the faster backends, so that the requested one is used
+    if request.param == 'cucim':
+        cp = pytest.importorskip('cupy')
+        pytest.importorskip('cucim')
+        if not cp.cuda.is_available():
+            pytest.skip('no CUDA device')
+    else:
+        for module in ('cupy', 'cucim'):
+            monkeypatch.setitem(sys.modules, module, None)
+        if request.param == 'edt':
+            pytest.importorskip('edt')
+        else:
+            monkeypatch.setitem(sys.modules, 'edt', None)
+    monkeypatch.chdir(tmp_path)
+    return request.param
+
+
+def test_phantom(backend, tmp_path):
+    orig, dest = phantom()
+    ndist = run_ndist(tmp_path, orig, dest)
+    assert ndist.dtype == np.float32
+    np.testing.assert_array_equal(ndist, reference_ndist(orig, dest))
+
+
+def test_limits(backend, tmp_path):
+    orig, dest = phantom()
+    ndist = run_ndist(tmp_path, orig, dest)
+    assert np.all(ndist[orig > 0] == 0.)
+    assert np.all(ndist[dest > 0] == 1.)